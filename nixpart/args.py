@@ -73,6 +73,13 @@ def parse_args(args=None):
              " relative to the given path (which is \"/mnt\" if absent)."
     )
 
+    parser.add_argument(
+        '-b', '--batch', dest='batched', action='store_true',
+        help="Execute actions grouped by disk, writing partition tables and"
+             " waiting for udev only once per group (not allowed with"
+             " -m/--mount)"
+    )
+
     parser.add_argument(
         '-J', '--json', dest='is_json', action='store_true',
         help="The provided NixOS configuration file is already in JSON format"
@@ -133,4 +140,7 @@ def parse_args(args=None):
 
         newargs.append(arg)
 
-    return parser.parse_args(args=newargs)
+    result = parser.parse_args(args=newargs)
+    if result.batched and result.mount is not None:
+        parser.error("argument -b/--batch: not allowed with -m/--mount")
+    return result
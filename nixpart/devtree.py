@@ -1,9 +1,20 @@
 import os
+import logging
 import subprocess
 import blivet
 
+from contextlib import contextmanager
+
+from blivet import udev
 from blivet.size import Size
+from blivet.callbacks import callbacks as blivet_callbacks
+from blivet.devices import PartitionDevice
+from blivet.errors import DiskLabelCommitError
+from blivet.formats.disklabel import DiskLabel
 from blivet.partitioning import do_partitioning
+from blivet.threads import blivet_lock
+
+log = logging.getLogger('nixpart')
 
 
 class DeviceTreeError(Exception):
@@ -25,6 +36,369 @@ def expr2size(expr):
     return size_acc
 
 
+def action_disks(action):
+    """
+    Return the names of the disks the device of 'action' resides on as a
+    sorted tuple, so it can be used as a key for grouping actions by disk.
+    """
+    return tuple(sorted(disk.name for disk in action.device.disks))
+
+
+def is_partition_create(action):
+    """
+    Check whether 'action' creates a new partition and thus needs to commit
+    the partition table of its disk.
+    """
+    return (action.is_create and action.is_device and
+            isinstance(action.device, PartitionDevice))
+
+
+def touches_disklabel(action):
+    """
+    Check whether 'action' modifies a partition table, which is when parted
+    may renumber the partitions on the affected disk.
+    """
+    if action.is_device:
+        return isinstance(action.device, PartitionDevice)
+    return action.device.is_disk
+
+
+def schedule_by_disk(actions):
+    """
+    Reorder the already sorted list of blivet 'actions' so that actions on the
+    same disk are adjacent and partitions are created right after each other.
+
+    Only the ordering requirements between actions (which are the same ones
+    blivet uses for sorting) are taken into account, so the result is still a
+    valid execution order.
+    """
+    requires = [{m for m, other in enumerate(actions)
+                 if other is not action and action.requires(other)}
+                for action in actions]
+    done = set()
+    ordered = []
+    current = None
+
+    while len(ordered) < len(actions):
+        ready = [n for n in range(len(actions))
+                 if n not in done and requires[n] <= done]
+        if len(ready) == 0:
+            raise DeviceTreeError("Cyclic dependency between actions.")
+        n = min(ready, key=lambda n: (action_disks(actions[n]) != current,
+                                      not is_partition_create(actions[n]),
+                                      n))
+        done.add(n)
+        ordered.append(actions[n])
+        current = action_disks(actions[n])
+
+    return ordered
+
+
+def group_actions(actions, key):
+    """
+    Split 'actions' into lists of consecutive actions for which the result of
+    'key' is the same.
+    """
+    groups = []
+    last = None
+    for action in actions:
+        value = key(action)
+        if len(groups) == 0 or value != last:
+            groups.append([])
+        groups[-1].append(action)
+        last = value
+    return groups
+
+
+class RealizeStats(object):
+    """
+    Counters collected by ActionBatcher while executing actions.
+
+    Next to the partition table commits, udev settles and partition rescans
+    that were actually performed, the number blivet's do_it() would have
+    performed for the same actions is recorded, so the '*_avoided' properties
+    are relative to do_it().
+    """
+    def __init__(self):
+        self.batches = 0
+        self.commits = 0
+        self.commits_expected = 0
+        self.settles = 0
+        self.settles_expected = 0
+        self.rescans = 0
+        self.rescans_expected = 0
+
+    @property
+    def commits_avoided(self):
+        return self.commits_expected - self.commits
+
+    @property
+    def settles_avoided(self):
+        return self.settles_expected - self.settles
+
+    @property
+    def rescans_avoided(self):
+        return self.rescans_expected - self.rescans
+
+    def __repr__(self):
+        return ("<RealizeStats batches={} commits={} (avoided {})"
+                " settles={} (avoided {}) rescans={} (avoided {})>").format(
+                    self.batches, self.commits, self.commits_avoided,
+                    self.settles, self.settles_avoided,
+                    self.rescans, self.rescans_avoided)
+
+
+class ActionBatcher(object):
+    """
+    Execute the queued actions of a blivet instance grouped by disk.
+
+    Runs of partition creations on the same disk only write the partition
+    table once and wait for udev once afterwards instead of once for every
+    partition. The partition names are only re-read when the partition table
+    of their disk has been changed and the final state is verified in a single
+    pass at the end.
+    """
+    def __init__(self, blivet_obj):
+        self._blivet = blivet_obj
+        self._suppress_settle = False
+        self._extra = False
+        self._deferred = None
+        self._deferred_commits = 0
+        self.stats = RealizeStats()
+
+    def _settle(self, *args, **kwargs):
+        if not self._extra:
+            self.stats.settles_expected += 1
+        if self._suppress_settle:
+            return
+        self.stats.settles += 1
+        self._orig_settle(*args, **kwargs)
+
+    def _commit(self, disklabel):
+        self.stats.commits_expected += 1
+        if self._deferred is None:
+            self.stats.commits += 1
+            self._orig_commit(disklabel)
+        else:
+            # The skipped commit would also have waited for udev.
+            self.stats.settles_expected += 1
+            self._deferred_commits += 1
+
+    def _post_create(self, partition):
+        if self._deferred is None:
+            self._orig_post_create(partition)
+        else:
+            self._deferred.append(partition)
+
+    @contextmanager
+    def _hooked(self):
+        """
+        Temporarily route udev settles, partition table commits and the
+        post-creation steps of partitions through this instance.
+        """
+        self._orig_settle = udev.settle
+        self._orig_commit = DiskLabel.commit
+        self._orig_post_create = PartitionDevice._post_create
+
+        udev.settle = self._settle
+        DiskLabel.commit = lambda disklabel: self._commit(disklabel)
+        PartitionDevice._post_create = \
+            lambda partition: self._post_create(partition)
+        try:
+            yield
+        finally:
+            udev.settle = self._orig_settle
+            DiskLabel.commit = self._orig_commit
+            PartitionDevice._post_create = self._orig_post_create
+
+    @contextmanager
+    def _extra_work(self):
+        """
+        Don't count the settles within this context as being done by do_it()
+        as well.
+        """
+        self._extra = True
+        try:
+            yield
+        finally:
+            self._extra = False
+
+    def _partitions(self, devices):
+        return [device for device in devices
+                if device.exists and isinstance(device, PartitionDevice)]
+
+    def _rescan(self, devices, disks, action=None, expected=True):
+        """
+        Update the names of existing partitions on 'disks' to catch any
+        renumbering done by parted.
+
+        If 'expected' is True, the rescan of all partitions do_it() would have
+        done at this point is accounted for.
+        """
+        for device in self._partitions(devices):
+            if action is not None and not device.disklabel_supported and \
+               action.is_destroy and action.is_format and \
+               action.device == device.disk:
+                device.exists = False
+                continue
+
+            if expected:
+                self.stats.rescans_expected += 1
+
+            if device.disk.name in disks:
+                device.update_name()
+                device.format.device = device.path
+                self.stats.rescans += 1
+
+    def _teardown_dependents(self, disks, devices):
+        """
+        Tear down all devices on 'disks' which might have been set up by a
+        previous action and thus prevent the partition table from being
+        committed, just like ActionList.process() does.
+        """
+        pending = [action.device for action in
+                   self._blivet.devicetree.actions._actions]
+        for dep in set(devices + pending):
+            if dep.exists and any(dep.depends_on(disk) for disk in disks):
+                dep.teardown(recursive=True)
+
+    def _complete(self, action):
+        actions = self._blivet.devicetree.actions
+        actions._completed_actions.append(actions._actions.pop(0))
+        blivet_callbacks.action_executed(action=action)
+
+    def _execute(self, action, devices):
+        with blivet_lock:
+            try:
+                action.execute()
+            except DiskLabelCommitError:
+                self._teardown_dependents(action.device.disks, devices)
+                action.execute()
+
+            if touches_disklabel(action):
+                self._rescan(devices, action_disks(action), action=action)
+            else:
+                self._rescan(devices, ())
+            self._complete(action)
+
+    def _commit_disk(self, disk, devices):
+        """
+        Commit the partition table of 'disk', retrying once after tearing down
+        the devices depending on it.
+        """
+        with self._extra_work():
+            self.stats.commits += 1
+            try:
+                self._orig_commit(disk.format)
+            except DiskLabelCommitError:
+                self._teardown_dependents([disk], devices)
+                self.stats.commits += 1
+                self._orig_commit(disk.format)
+
+    def _remove_partitions(self, disklabel, partitions):
+        """
+        Remove 'partitions' which haven't been committed from 'disklabel', like
+        PartitionDevice._create() does if committing fails.
+        """
+        for partition in partitions:
+            part = disklabel.parted_disk.getPartitionByPath(partition.path)
+            disklabel.remove_partition(part)
+
+    def _create_partitions(self, actions, devices):
+        """
+        Create the partitions of 'actions' (which all need to be on the same
+        disk) by writing the partition table and waiting for udev only once.
+        """
+        disk = actions[0].device.disk
+        existing = len(self._partitions(devices))
+        added = []
+
+        with blivet_lock:
+            self._deferred = []
+            try:
+                try:
+                    for action in actions:
+                        log.info("executing action: %s", action)
+                        commits = self._deferred_commits
+                        self._suppress_settle = True
+                        try:
+                            action.execute()
+                        finally:
+                            self._suppress_settle = False
+                            if self._deferred_commits > commits:
+                                added.append(action.device)
+                finally:
+                    deferred, self._deferred = self._deferred, None
+                self._commit_disk(disk, devices)
+            except Exception:
+                self._remove_partitions(disk.format, added)
+                raise
+
+            self._suppress_settle = True
+            try:
+                for partition in deferred:
+                    self._orig_post_create(partition)
+            finally:
+                self._suppress_settle = False
+            with self._extra_work():
+                udev.settle()
+
+            # Without deferring, every partition creation would have
+            # rescanned all partitions existing at that point.
+            for n in range(1, len(actions) + 1):
+                self.stats.rescans_expected += existing + n
+            self._rescan(devices, action_disks(actions[0]), expected=False)
+            for action in actions:
+                self._complete(action)
+
+    def _verify(self, devices):
+        """
+        Wait for udev a last time and make sure all partitions have their
+        final names and device nodes.
+        """
+        with self._extra_work():
+            udev.settle()
+        missing = []
+        for device in self._partitions(devices):
+            device.update_name()
+            device.format.device = device.path
+            self.stats.rescans += 1
+            if not os.path.exists(device.path):
+                missing.append(device.path)
+        if len(missing) > 0:
+            msg = "Device nodes missing after realizing: {}."
+            raise DeviceTreeError(msg.format(', '.join(missing)))
+
+    def run(self):
+        actions = self._blivet.devicetree.actions
+        devices = self._blivet.devices
+
+        actions._pre_process(devices=devices)
+        actions._actions = schedule_by_disk(actions._actions)
+
+        actions.processing = True
+        try:
+            with self._hooked():
+                for batch in group_actions(actions._actions[:], action_disks):
+                    self.stats.batches += 1
+                    log.info("executing %d action(s) on %s", len(batch),
+                             ', '.join(action_disks(batch[0])) or "no disk")
+                    for run in group_actions(batch, is_partition_create):
+                        if is_partition_create(run[0]):
+                            self._create_partitions(run, devices)
+                        else:
+                            for action in run:
+                                log.info("executing action: %s", action)
+                                self._execute(action, devices)
+                self._verify(devices)
+        finally:
+            actions.processing = False
+
+        actions._post_process(devices=devices)
+        log.info("realized devices: %r", self.stats)
+        return self.stats
+
+
 class DeviceTree(object):
     def __init__(self):
         self._blivet = blivet.Blivet()
@@ -189,9 +563,18 @@ class DeviceTree(object):
     def devices(self):
         return self._blivet.devicetree.devices
 
-    def realize(self):
+    def realize(self, batched=False):
+        """
+        Partition the disks and create all devices and filesystems.
+
+        If 'batched' is True, the actions are executed grouped by disk using
+        ActionBatcher, which logs the collected RealizeStats.
+        """
         do_partitioning(self._blivet)
-        self._blivet.do_it()
+        if batched:
+            ActionBatcher(self._blivet).run()
+        else:
+            self._blivet.do_it()
 
     def mount(self, sysroot):
         blivet.flags.installer_mode = True
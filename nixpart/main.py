@@ -47,7 +47,7 @@ def main():
 
         handler = logging.StreamHandler(sys.stderr)
 
-        for name in ['blivet', 'program']:
+        for name in ['blivet', 'program', 'nixpart']:
             logger = logging.getLogger(name)
             logger.setLevel(level)
             logger.addHandler(handler)
@@ -64,4 +64,4 @@ def main():
     elif args.mount is not None:
         devtree.mount(args.mount)
     else:
-        devtree.realize()
+        devtree.realize(batched=args.batched)
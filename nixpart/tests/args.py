@@ -42,6 +42,17 @@ class ArgsTest(unittest.TestCase):
         self.assertIn('mount', result)
         self.assertIsNone(result.mount)
 
+    def test_batch_defaults_to_false(self):
+        self.assertFalse(parse_args([self.cfg]).batched)
+        self.assertTrue(parse_args(['-b', self.cfg]).batched)
+        self.assertTrue(parse_args(['--batch', self.cfg]).batched)
+
+    def test_batch_with_mount(self):
+        with patch('sys.stderr', io.StringIO()) as stderr_io, \
+             self.assertRaises(SystemExit):
+            parse_args(['-b', '-m', self.cfg])
+        self.assertIn("not allowed with -m/--mount", stderr_io.getvalue())
+
     def test_help_formatting(self):
         with patch('sys.stdout', io.StringIO()) as stdout_io, \
              patch('sys.stderr', io.StringIO()) as stderr_io, \
@@ -1,11 +1,16 @@
 import unittest
 
-from unittest.mock import patch, Mock, MagicMock
+from unittest.mock import patch, call, Mock, MagicMock
+
+import blivet
 
 from blivet.size import Size
-from blivet.devices import DiskDevice
+from blivet.devices import DiskDevice, PartitionDevice
+from blivet.errors import DiskLabelCommitError
+from blivet.formats.disklabel import DiskLabel
 
-from nixpart.devtree import DeviceTree
+from nixpart.devtree import (DeviceTree, DeviceTreeError, ActionBatcher,
+                             schedule_by_disk, group_actions, action_disks)
 
 
 class DeviceTreeTest(unittest.TestCase):
@@ -75,3 +80,164 @@ class DeviceTreeTest(unittest.TestCase):
         self.assertEqual(Size("1 MiB"), result['/dev/test2'].size)
         self.assertEqual(Size("10 MB") + Size("4 YB"),
                          result['/dev/test3'].size)
+
+
+class ScheduleTest(unittest.TestCase):
+    def action(self, disk, requires=(), partition=False):
+        device = MagicMock(spec=PartitionDevice) if partition else Mock()
+        device.disks = [Mock()]
+        device.disks[0].name = disk
+        action = Mock(is_create=partition, is_device=partition,
+                      device=device)
+        action.requires = lambda other: other in requires
+        return action
+
+    def test_group_by_disk(self):
+        label_a = self.action('a')
+        label_b = self.action('b')
+        part_b1 = self.action('b', requires=[label_b], partition=True)
+        part_a1 = self.action('a', requires=[label_a], partition=True)
+        part_a2 = self.action('a', requires=[label_a, part_a1],
+                              partition=True)
+        fmt_a1 = self.action('a', requires=[part_a1])
+        actions = [label_a, label_b, part_b1, part_a1, fmt_a1, part_a2]
+        result = schedule_by_disk(actions)
+        self.assertEqual([label_a, part_a1, part_a2, fmt_a1,
+                          label_b, part_b1], result)
+        groups = group_actions(result, action_disks)
+        self.assertEqual([[label_a, part_a1, part_a2, fmt_a1],
+                          [label_b, part_b1]], groups)
+
+    def test_keep_requirements(self):
+        disk_a = self.action('a')
+        disk_b = self.action('b', requires=[disk_a])
+        other_a = self.action('a', requires=[disk_b])
+        result = schedule_by_disk([disk_a, disk_b, other_a])
+        self.assertEqual([disk_a, disk_b, other_a], result)
+
+
+class ActionBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.settle = Mock(side_effect=lambda: self.calls.append('settle'))
+        self.commit = Mock(side_effect=self.fake_commit)
+        self.post_create = Mock(side_effect=self.fake_post_create)
+        self.exists = Mock(return_value=True)
+        patchers = [
+            patch('blivet.udev.settle', self.settle),
+            patch('blivet.formats.disklabel.DiskLabel.commit', self.commit),
+            patch('blivet.devices.PartitionDevice._post_create',
+                  self.post_create),
+            patch('nixpart.devtree.blivet_callbacks'),
+            patch('os.path.exists', self.exists),
+        ]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        self.disk = Mock(exists=True)
+        self.disk.name = 'sda'
+        self.disk.disks = [self.disk]
+        self.devices = [self.disk]
+
+    def fake_commit(self, disklabel):
+        self.calls.append('commit')
+        blivet.udev.settle()
+
+    def fake_post_create(self, partition):
+        self.calls.append('post_create ' + partition.name)
+        partition.exists = True
+        blivet.udev.settle()
+        blivet.udev.settle()
+
+    def add_partition(self, name):
+        """
+        Queue the creation of partition 'name' on the disk, simulating the
+        steps of PartitionDevice.create().
+        """
+        partition = MagicMock(spec=PartitionDevice, exists=False,
+                              disk=self.disk, disks=[self.disk],
+                              disklabel_supported=True)
+        partition.name = name
+        partition.path = '/dev/' + name
+
+        def _create():
+            self.disk.format.add_partition(name)
+            blivet.udev.settle()
+            DiskLabel.commit(self.disk.format)
+            PartitionDevice._post_create(partition)
+
+        action = Mock(is_create=True, is_device=True, device=partition)
+        action.execute = Mock(side_effect=_create)
+        action.requires = lambda other: False
+        self.devices.append(partition)
+        return action
+
+    def run_batcher(self, actions):
+        storage = Mock(devices=self.devices)
+        storage.devicetree.actions._actions = list(actions)
+        storage.devicetree.actions._completed_actions = []
+        self.addCleanup(self.assert_restored)
+        return storage, ActionBatcher(storage).run()
+
+    def assert_restored(self):
+        self.assertIs(self.settle, blivet.udev.settle)
+        self.assertIs(self.commit, DiskLabel.commit)
+        self.assertIs(self.post_create, PartitionDevice._post_create)
+
+    def test_partitions_committed_once(self):
+        actions = [self.add_partition('sda' + str(n)) for n in range(1, 4)]
+        storage, stats = self.run_batcher(actions)
+
+        self.assertEqual(['commit', 'settle',
+                          'post_create sda1', 'post_create sda2',
+                          'post_create sda3', 'settle', 'settle'],
+                         self.calls)
+        self.assertEqual(actions,
+                         storage.devicetree.actions._completed_actions)
+        self.assertEqual(1, stats.batches)
+        self.assertEqual(1, stats.commits)
+        self.assertEqual(2, stats.commits_avoided)
+        # Each creation would have done one settle for wiping, one in the
+        # commit and two after creating the partition.
+        self.assertEqual(3, stats.settles)
+        self.assertEqual(3 * 4 - 3, stats.settles_avoided)
+        # Rescans after each creation (1 + 2 + 3) against one rescan after the
+        # commit and the final one.
+        self.assertEqual(6, stats.rescans)
+        self.assertEqual(0, stats.rescans_avoided)
+
+    def test_commit_failure_removes_partitions(self):
+        actions = [self.add_partition('sda1'), self.add_partition('sda2')]
+        self.commit.side_effect = DiskLabelCommitError("failed")
+        with self.assertRaises(DiskLabelCommitError):
+            self.run_batcher(actions)
+
+        # Committed once and retried once.
+        self.assertEqual(2, self.commit.call_count)
+        self.post_create.assert_not_called()
+        disklabel = self.disk.format
+        disklabel.parted_disk.getPartitionByPath.assert_has_calls([
+            call('/dev/sda1'), call('/dev/sda2'),
+        ])
+        self.assertEqual(2, disklabel.remove_partition.call_count)
+
+    def test_execute_failure_removes_partitions(self):
+        actions = [self.add_partition('sda1'), self.add_partition('sda2')]
+        actions[1].execute.side_effect = RuntimeError("failed")
+        with self.assertRaises(RuntimeError):
+            self.run_batcher(actions)
+
+        self.commit.assert_not_called()
+        self.post_create.assert_not_called()
+        disklabel = self.disk.format
+        disklabel.parted_disk.getPartitionByPath.assert_called_once_with(
+            '/dev/sda1'
+        )
+        self.assertEqual(1, disklabel.remove_partition.call_count)
+
+    def test_verify_missing_nodes(self):
+        self.exists.side_effect = lambda path: path != '/dev/sda2'
+        actions = [self.add_partition('sda1'), self.add_partition('sda2')]
+        with self.assertRaisesRegex(DeviceTreeError, '/dev/sda2'):
+            self.run_batcher(actions)